@@ -1,9 +1,14 @@
 """A simple Google-style logging wrapper."""
 
+import atexit
+import io
+import linecache
 import logging
+import operator
+import re
 import time
-import traceback
 import os
+import sys
 
 import gflags as flags
 
@@ -11,11 +16,43 @@ FLAGS = flags.FLAGS
 
 
 def format_message(record):
-    try:
-        record_message = '%s' % (record.msg % record.args)
-    except TypeError:
-        record_message = record.msg
-    return record_message
+    msg = record.msg
+    args = record.args
+    # Like LogRecord.getMessage, only %-format when there are arguments.
+    if args:
+        try:
+            return '%s' % (msg % args)
+        except TypeError:
+            pass
+    return msg if isinstance(msg, str) else '%s' % (msg,)
+
+
+def _format_date(sec):
+    return '%02d%02d %02d:%02d:%02d' % time.localtime(sec)[1:6]
+
+
+# One-slot cache of (integer second, "MMDD HH:MM:SS"); log bursts tend to
+# share the same wallclock second, so localtime() and the date formatting run
+# about once per second.  The pair is swapped in as a single tuple so
+# concurrent readers never see a second paired with another second's text.
+_last_date = (None, None)
+
+
+def _format_date_cached(sec):
+    global _last_date
+    cached_sec, date = _last_date
+    if sec != cached_sec:
+        date = _format_date(sec)
+        _last_date = (sec, date)
+    return date
+
+
+def _format_line(level, date, usec, process, filename, lineno, message):
+    """Assemble one glog line from its already-looked-up parts."""
+    return ''.join((
+        level, date, '.%06d ' % usec,
+        str(process) if process is not None else '?????',
+        ' ', filename, ':', str(lineno), '] ', message))
 
 
 class GlogFormatter(logging.Formatter):
@@ -35,20 +72,73 @@ class GlogFormatter(logging.Formatter):
             level = GlogFormatter.LEVEL_MAP[record.levelno]
         except KeyError:
             level = '?'
-        date = time.localtime(record.created)
-        date_usec = (record.created - int(record.created)) * 1e6
-        record_message = '%c%02d%02d %02d:%02d:%02d.%06d %s %s:%d] %s' % (
-            level, date.tm_mon, date.tm_mday, date.tm_hour, date.tm_min,
-            date.tm_sec, date_usec,
-            record.process if record.process is not None else '?????',
-            record.filename,
-            record.lineno,
-            format_message(record))
-        record.getMessage = lambda: record_message
-        return logging.Formatter.format(self, record)
+        sec, usec = divmod(int(record.created * 1000000), 1000000)
+        record_message = _format_line(
+            level, _format_date_cached(sec), usec, record.process,
+            record.filename, record.lineno, format_message(record))
+        record.message = record_message
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = record.exc_text = self.formatException(record.exc_info)
+        if exc_text:
+            if record_message[-1:] != '\n':
+                record_message = record_message + '\n'
+            try:
+                record_message = record_message + exc_text
+            except UnicodeError:
+                # Python 2: unicode message with a non-ASCII byte traceback.
+                record_message = record_message + exc_text.decode(
+                    sys.getfilesystemencoding(), 'replace')
+        stack_info = getattr(record, 'stack_info', None)
+        if stack_info:
+            if record_message[-1:] != '\n':
+                record_message = record_message + '\n'
+            record_message = record_message + self.formatStack(stack_info)
+        return record_message
+
+
+def format_prefix_batch(levels, secs, usecs, pids, files, lines, msgs):
+    """Format many glog lines at once, e.g. when re-emitting parsed logs.
+
+    Each argument is a sequence with one entry per line: numeric log level,
+    integer epoch seconds, microseconds, process id, source file basename,
+    line number and message text.  Returns a list of formatted lines.
+    """
+    level_map = GlogFormatter.LEVEL_MAP
+    # A local cache, so replaying old timestamps doesn't evict the live
+    # formatter's cached second.
+    dates = {}
+    result = []
+    for levelno, sec, usec, pid, filename, lineno, msg in zip(
+            levels, secs, usecs, pids, files, lines, msgs):
+        date = dates.get(sec)
+        if date is None:
+            date = dates[sec] = _format_date(sec)
+        result.append(_format_line(level_map.get(levelno, '?'), date, usec,
+                                   pid, filename, lineno, msg))
+    return result
+
+
+class _StderrHandler(logging.StreamHandler):
+    """StreamHandler that can skip the flush after every record."""
+
+    line_buffered = True
+
+    def emit(self, record):
+        if self.line_buffered:
+            logging.StreamHandler.emit(self, record)
+            return
+        try:
+            self.stream.write(self.format(record) +
+                              getattr(self, 'terminator', '\n'))
+        except Exception:
+            self.handleError(record)
+
+
+STDERR_BUFFER_SIZE = 65536
 
 logger = logging.getLogger()
-handler = logging.StreamHandler()
+handler = _StderrHandler()
 
 
 def setLevel(newlevel):
@@ -56,17 +146,104 @@ def setLevel(newlevel):
     logger.debug('Log level set to %s', newlevel)
 
 
+def setLineBuffered(line_buffered):
+    """Choose whether each log line is flushed to stderr as it is written.
+
+    Line buffering is the default.  Turning it off batches output through a
+    STDERR_BUFFER_SIZE buffer that is written when full and at interpreter
+    exit, replacing one write() per record with one per buffer.  Call
+    handler.flush() to write pending lines early.  Where os.register_at_fork
+    exists, pending lines are flushed before a fork and the child process
+    goes back to line buffering.  Lines still buffered when the process
+    dies without running atexit hooks (os._exit, a signal, a crash) are lost.
+
+    The buffered stream writes to a duplicate of the file descriptor behind
+    sys.stderr, so later Python-level reassignments of sys.stderr are not
+    followed.  If sys.stderr has no file descriptor (e.g. it was redirected
+    to a StringIO, or under Jupyter), line buffering is left on.
+    """
+    handler.acquire()
+    try:
+        if line_buffered == handler.line_buffered:
+            return
+        if not line_buffered:
+            try:
+                fileno = sys.stderr.fileno()
+            except (AttributeError, ValueError):  # io.UnsupportedOperation
+                return
+        handler.stream.flush()
+        if line_buffered:
+            handler.stream.close()
+            handler.stream = sys.stderr
+        else:
+            fd = os.dup(fileno)
+            if hasattr(sys.stderr, 'buffer'):
+                handler.stream = io.open(
+                    fd, 'w', buffering=STDERR_BUFFER_SIZE,
+                    encoding=sys.stderr.encoding or 'utf-8',
+                    errors='backslashreplace')
+            else:  # Python 2 loggers write byte strings
+                handler.stream = os.fdopen(fd, 'w', STDERR_BUFFER_SIZE)
+        handler.line_buffered = line_buffered
+    finally:
+        handler.release()
+
+
+@atexit.register
+def _flush_buffered_stream():
+    if not handler.line_buffered:
+        handler.flush()
+
+
+def _line_buffer_in_child():
+    setLineBuffered(True)
+
+
+# Flush before forking so the child doesn't inherit and rewrite pending lines,
+# and go back to line buffering in the child: children such as multiprocessing
+# workers leave via os._exit, which skips the atexit flush.
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_flush_buffered_stream,
+                        after_in_child=_line_buffer_in_child)
+
+
 def init():
     setLevel(FLAGS.verbosity)
 
-debug = logging.debug
-info = logging.info
-warning = logging.warning
-warn = logging.warning
-error = logging.error
-exception = logging.exception
-fatal = logging.fatal
-log = logging.log
+# Bound methods of the root logger: they check isEnabledFor() before building
+# a record, without the extra call and handler check of logging.debug & co.
+debug = logger.debug
+info = logger.info
+warning = logger.warning
+warn = logger.warning
+error = logger.error
+exception = logger.exception
+fatal = logger.critical
+log = logger.log
+
+
+class lazy(object):
+    """Defer an expensive computation until a log message is formatted.
+
+    Arguments are only %-formatted when a record is actually emitted, so
+
+        log.debug('state: %s', log.lazy(pprint.pformat, state))
+
+    never calls pformat while DEBUG is disabled.
+    """
+
+    __slots__ = ('func', 'args', 'kwargs')
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return '%s' % (self.func(*self.args, **self.kwargs),)
+
+    def __repr__(self):
+        return repr(self.func(*self.args, **self.kwargs))
 
 DEBUG = logging.DEBUG
 INFO = logging.INFO
@@ -83,11 +260,13 @@ _level_names = {
     FATAL: 'FATAL'
 }
 
-_level_letters = [name[0] for name in _level_names.values()]
+# First letters of _level_names in severity order, independent of dict order.
+_level_letters = ''.join(_level_names[level][0]
+                         for level in sorted(_level_names))
 
 GLOG_PREFIX_REGEX = (
-    r"""
-    (?x) ^
+    r"""(?x)
+    ^
     (?P<severity>[%s])
     (?P<month>\d\d)(?P<day>\d\d)\s
     (?P<hour>\d\d):(?P<minute>\d\d):(?P<second>\d\d)
@@ -95,9 +274,12 @@ GLOG_PREFIX_REGEX = (
     (?P<process_id>-?\d+)\s
     (?P<filename>[a-zA-Z<_][\w._<>-]+):(?P<line>\d+)
     \]\s
-    """) % ''.join(_level_letters)
+    """) % _level_letters
 """Regex you can use to parse glog line prefixes."""
 
+GLOG_PREFIX_PATTERN = re.compile(GLOG_PREFIX_REGEX)
+"""Compiled GLOG_PREFIX_REGEX; use GLOG_PREFIX_PATTERN.match(line)."""
+
 handler.setFormatter(GlogFormatter())
 logger.addHandler(handler)
 
@@ -141,16 +323,56 @@ flags.DEFINE(
 # Define functions emulating C++ glog check-macros
 # https://htmlpreview.github.io/?https://github.com/google/glog/master/doc/glog.html#check
 
+_basename_cache = {}
+
+
+def _basename(path):
+    name = _basename_cache.get(path)
+    if name is None:
+        name = _basename_cache.setdefault(path, os.path.basename(path))
+    return name
+
+
+def _extract_stack(frame):
+    """Return (filename, line, function) triples from frame up, oldest first.
+
+    Unlike traceback.extract_stack this does not read any source lines; it
+    only registers module globals with linecache so that source from zip
+    imports and other loaders can still be found later.
+    """
+    lazycache = getattr(linecache, 'lazycache', None)  # Python 3.5+
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        if lazycache is not None:
+            lazycache(code.co_filename, frame.f_globals)
+        stack.append((code.co_filename, frame.f_lineno, code.co_name))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
 def format_stacktrace(stack):
     """Print a stack trace that is easier to read.
 
     * Reduce paths to basename component
     * Truncates the part of the stack after the check failure
+
+    Entries are traceback-style (filename, line, function[, text]) tuples;
+    text is looked up with linecache when missing.
     """
     lines = []
-    for _, f in enumerate(stack):
-        fname = os.path.basename(f[0])
-        line = "\t%s:%d\t%s" % (fname + "::" + f[2], f[1], f[3])
+    checked = set()
+    for f in stack:
+        if len(f) > 3:
+            text = f[3]
+        else:
+            if f[0] not in checked:
+                # Drop cached text for files that changed since it was read.
+                linecache.checkcache(f[0])
+                checked.add(f[0])
+            text = linecache.getline(f[0], f[1]).strip()
+        line = "\t%s:%d\t%s" % (_basename(f[0]) + "::" + f[2], f[1], text)
         lines.append(line)
     return lines
 
@@ -160,27 +382,21 @@ class FailedCheckException(AssertionError):
 
 
 def check_failed(message):
-    stack = traceback.extract_stack()
-    stack = stack[0:-2]
+    # Skip this frame and the check_* function that called it.
+    stack = _extract_stack(sys._getframe(2))
     stacktrace_lines = format_stacktrace(stack)
-    filename, line_num, _, _ = stack[-1]
+    filename, line_num, _ = stack[-1]
 
-    try:
-        raise FailedCheckException(message)
-    except FailedCheckException:
-        log_record = logger.makeRecord('CRITICAL', 50, filename, line_num,
-                                       message, None, None)
-        handler.handle(log_record)
-
-        log_record = logger.makeRecord('DEBUG', 10, filename, line_num,
-                                       'Check failed here:', None, None)
-        handler.handle(log_record)
-        for line in stacktrace_lines:
-            log_record = logger.makeRecord('DEBUG', 10, filename, line_num,
-                                           line, None, None)
-            handler.handle(log_record)
-        raise
-    return
+    log_record = logger.makeRecord('CRITICAL', 50, filename, line_num,
+                                   message, None, None)
+    handler.handle(log_record)
+
+    # One record for the whole trace: a single format and write.
+    log_record = logger.makeRecord(
+        'DEBUG', 10, filename, line_num,
+        '\n'.join(['Check failed here:'] + stacktrace_lines), None, None)
+    handler.handle(log_record)
+    raise FailedCheckException(message)
 
 
 def check(condition, message=None):
@@ -191,52 +407,37 @@ def check(condition, message=None):
         check_failed(message)
 
 
-def check_eq(obj1, obj2, message=None):
-    """Raise exception with message if obj1 != obj2."""
-    if obj1 != obj2:
-        if message is None:
-            message = "Check failed: %s != %s" % (str(obj1), str(obj2))
-        check_failed(message)
-
-
-def check_ne(obj1, obj2, message=None):
-    """Raise exception with message if obj1 == obj2."""
-    if obj1 == obj2:
-        if message is None:
-            message = "Check failed: %s == %s" % (str(obj1), str(obj2))
-        check_failed(message)
-
-
-def check_le(obj1, obj2, message=None):
-    """Raise exception with message if not (obj1 <= obj2)."""
-    if obj1 > obj2:
-        if message is None:
-            message = "Check failed: %s > %s" % (str(obj1), str(obj2))
-        check_failed(message)
-
-
-def check_ge(obj1, obj2, message=None):
-    """Raise exception with message unless (obj1 >= obj2)."""
-    if obj1 < obj2:
-        if message is None:
-            message = "Check failed: %s < %s" % (str(obj1), str(obj2))
-        check_failed(message)
-
-
-def check_lt(obj1, obj2, message=None):
-    """Raise exception with message unless (obj1 < obj2)."""
-    if obj1 >= obj2:
-        if message is None:
-            message = "Check failed: %s >= %s" % (str(obj1), str(obj2))
-        check_failed(message)
-
-
-def check_gt(obj1, obj2, message=None):
-    """Raise exception with message unless (obj1 > obj2)."""
-    if obj1 <= obj2:
-        if message is None:
-            message = "Check failed: %s <= %s" % (str(obj1), str(obj2))
-        check_failed(message)
+def _make_check(name, pass_symbol, fail_op, fail_symbol):
+    def check_op(obj1, obj2, message=None):
+        if fail_op(obj1, obj2):
+            if message is None:
+                message = "Check failed: %s %s %s" % (str(obj1), fail_symbol,
+                                                      str(obj2))
+            check_failed(message)
+    check_op.__name__ = name
+    if hasattr(check_op, '__qualname__'):
+        check_op.__qualname__ = name
+    if hasattr(check_op.__code__, 'replace'):  # Python 3.8+
+        # Tracebacks report co_name, not __name__.
+        check_op.__code__ = check_op.__code__.replace(co_name=name)
+    check_op.__doc__ = ("Raise exception with message unless (obj1 %s obj2)."
+                        % pass_symbol)
+    return check_op
+
+
+# (name, passing comparison, failing comparison, failing symbol)
+_CHECK_OPS = [
+    ('check_eq', '==', operator.ne, '!='),
+    ('check_ne', '!=', operator.eq, '=='),
+    ('check_le', '<=', operator.gt, '>'),
+    ('check_ge', '>=', operator.lt, '<'),
+    ('check_lt', '<', operator.ge, '>='),
+    ('check_gt', '>', operator.le, '<='),
+]
+
+for _check_op in _CHECK_OPS:
+    globals()[_check_op[0]] = _make_check(*_check_op)
+del _check_op
 
 
 def check_notnone(obj, message=None):
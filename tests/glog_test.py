@@ -1,7 +1,17 @@
 #!/usr/bin/env python
 
 import glog as log
+import io
+import logging
+import os
+import pickle
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
+import zipfile
 
 
 class TestLoggingMethods(unittest.TestCase):
@@ -24,6 +34,158 @@ class TestLoggingMethods(unittest.TestCase):
     def test_fatal(self):
         log.fatal('test')
 
+    def test_lazy(self):
+        calls = []
+
+        def expensive(value):
+            calls.append(value)
+            return value * 2
+
+        old_level = log.logger.level
+        log.setLevel(log.INFO)
+        try:
+            log.debug('value: %s', log.lazy(expensive, 21))
+            self.assertEqual(calls, [])
+        finally:
+            log.setLevel(old_level)
+        self.assertEqual('%s %r' % (log.lazy(expensive, 21),
+                                    log.lazy(str, 'x')), "42 'x'")
+
+
+class TestGlogFormatter(unittest.TestCase):
+
+    def make_record(self, msg, args=None, exc_info=None,
+                    level=logging.INFO):
+        return logging.LogRecord('test', level, '/path/to/file.py', 42,
+                                 msg, args, exc_info)
+
+    def test_format_prefix(self):
+        record = self.make_record('hello %s', ('world',))
+        line = log.GlogFormatter().format(record)
+        self.assertTrue(re.match(r'I\d{4} \d\d:\d\d:\d\d\.\d{6} \d+ ', line))
+        self.assertTrue(line.endswith(' file.py:42] hello world'))
+
+    def test_format_microseconds(self):
+        record = self.make_record('usec')
+        record.created = 1500000000.000001
+        line = log.GlogFormatter().format(record)
+        self.assertEqual(log.GLOG_PREFIX_PATTERN.match(line).group(
+            'microsecond'), '000001')
+
+    def test_format_unknown_level(self):
+        record = self.make_record('custom', level=25)
+        self.assertTrue(log.GlogFormatter().format(record).startswith('?'))
+
+    def test_prefix_pattern_parses_formatted_line(self):
+        record = self.make_record('hello')
+        line = log.GlogFormatter().format(record)
+        match = log.GLOG_PREFIX_PATTERN.match(line)
+        self.assertIsNotNone(match)
+        self.assertEqual(match.group('severity'), 'I')
+        self.assertEqual(match.group('filename'), 'file.py')
+        self.assertEqual(match.group('line'), '42')
+        self.assertEqual(line[match.end():], 'hello')
+
+    def test_format_prefix_batch(self):
+        records = [self.make_record('one', level=logging.WARNING),
+                   self.make_record('two', level=logging.DEBUG)]
+        formatter = log.GlogFormatter()
+        expected = [formatter.format(record) for record in records]
+        secs, usecs = zip(*[divmod(int(record.created * 1000000), 1000000)
+                            for record in records])
+        lines = log.format_prefix_batch(
+            [record.levelno for record in records], secs, usecs,
+            [record.process for record in records], ['file.py'] * 2,
+            [42, 42], ['one', 'two'])
+        self.assertEqual(lines, expected)
+
+    def test_format_prefix_batch_keeps_live_date_cache(self):
+        log.GlogFormatter().format(self.make_record('live'))
+        live_cache = log._last_date
+        lines = log.format_prefix_batch([logging.INFO], [0], [0], [1],
+                                        ['old.py'], [1], ['replayed'])
+        self.assertTrue(lines[0].endswith(' 1 old.py:1] replayed'))
+        self.assertIs(log._last_date, live_cache)
+
+    def test_format_message_without_args(self):
+        self.assertEqual(log.format_message(self.make_record('100%')), '100%')
+        self.assertEqual(log.format_message(self.make_record(42)), '42')
+        self.assertEqual(
+            log.format_message(self.make_record('%d%%', (100,))), '100%')
+        self.assertEqual(log.format_message(self.make_record(42, (1,))), '42')
+
+    def test_format_exception(self):
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            record = self.make_record('failed', exc_info=sys.exc_info(),
+                                      level=logging.ERROR)
+        lines = log.GlogFormatter().format(record).splitlines()
+        self.assertTrue(lines[0].startswith('E'))
+        self.assertTrue(lines[0].endswith('] failed'))
+        self.assertEqual(lines[-1], 'ValueError: boom')
+        self.assertEqual(lines[1], 'Traceback (most recent call last):')
+
+    def test_format_exception_after_trailing_newline(self):
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            record = self.make_record('failed\n', exc_info=sys.exc_info())
+        lines = log.GlogFormatter().format(record).splitlines()
+        self.assertTrue(lines[0].endswith('] failed'))
+        self.assertEqual(lines[1], 'Traceback (most recent call last):')
+
+
+class TestLineBuffering(unittest.TestCase):
+
+    def test_buffered_output_flushed_at_exit(self):
+        script = ('import glog; glog.setLineBuffered(False); '
+                  'glog.info("buffered line")')
+        proc = subprocess.Popen([sys.executable, '-c', script],
+                                stderr=subprocess.PIPE,
+                                cwd=os.path.dirname(log.__file__) or '.')
+        _, err = proc.communicate()
+        self.assertEqual(proc.returncode, 0)
+        self.assertIn(b'] buffered line', err)
+
+    def test_explicit_flush_writes_buffered_output(self):
+        script = ('import glog, os; glog.setLineBuffered(False); '
+                  'glog.info("flushed line"); glog.handler.flush(); '
+                  'os._exit(0)')
+        proc = subprocess.Popen([sys.executable, '-c', script],
+                                stderr=subprocess.PIPE,
+                                cwd=os.path.dirname(log.__file__) or '.')
+        _, err = proc.communicate()
+        self.assertIn(b'] flushed line', err)
+
+    @unittest.skipUnless(hasattr(os, 'register_at_fork'), 'needs fork hooks')
+    def test_forked_child_output_not_lost(self):
+        script = ('import glog, os; glog.setLineBuffered(False); '
+                  'glog.info("before fork"); pid = os.fork()\n'
+                  'if pid == 0:\n'
+                  '    glog.info("in child"); os._exit(0)\n'
+                  'os.waitpid(pid, 0)')
+        proc = subprocess.Popen([sys.executable, '-c', script],
+                                stderr=subprocess.PIPE,
+                                cwd=os.path.dirname(log.__file__) or '.')
+        _, err = proc.communicate()
+        self.assertEqual(err.count(b'] before fork'), 1)
+        self.assertIn(b'] in child', err)
+
+    def test_stderr_without_fileno_stays_line_buffered(self):
+        old_stderr, sys.stderr = sys.stderr, io.StringIO()
+        try:
+            log.setLineBuffered(False)
+        finally:
+            sys.stderr = old_stderr
+        self.assertTrue(log.handler.line_buffered)
+
+    def test_restore_line_buffering(self):
+        log.setLineBuffered(False)
+        self.assertIsNot(log.handler.stream, sys.stderr)
+        log.setLineBuffered(True)
+        self.assertIs(log.handler.stream, sys.stderr)
+
 
 class TestCheckMethods(unittest.TestCase):
 
@@ -57,6 +219,59 @@ class TestCheckMethods(unittest.TestCase):
         log.check_gt(2, 1)
         self.assertRaises(log.FailedCheckException, log.check_gt, 1, 1)
 
+    def test_generated_checks_pickle(self):
+        for name in ('check_eq', 'check_ne', 'check_le', 'check_ge',
+                     'check_lt', 'check_gt'):
+            func = getattr(log, name)
+            self.assertEqual(func.__name__, name)
+            self.assertEqual(getattr(func, '__qualname__', name), name)
+            self.assertIs(pickle.loads(pickle.dumps(func)), func)
+            if hasattr(func.__code__, 'replace'):
+                self.assertEqual(func.__code__.co_name, name)
+
+    def test_check_failure_logs_stacktrace(self):
+        stream = io.StringIO() if sys.version_info[0] > 2 else io.BytesIO()
+        old_stream, log.handler.stream = log.handler.stream, stream
+        try:
+            with self.assertRaises(log.FailedCheckException):
+                log.check_eq(1, 2)
+        finally:
+            log.handler.stream = old_stream
+        lines = stream.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('F'))
+        self.assertTrue(lines[0].endswith('] Check failed: 1 != 2'))
+        self.assertTrue(lines[1].endswith('] Check failed here:'))
+        self.assertIn('glog_test.py::test_check_failure_logs_stacktrace',
+                      lines[-1])
+
+    def test_format_stacktrace(self):
+        stack = log._extract_stack(sys._getframe())
+        lines = log.format_stacktrace(stack)
+        self.assertEqual(
+            lines[-1], '\tglog_test.py::test_format_stacktrace:%d\t'
+            'stack = log._extract_stack(sys._getframe())' % stack[-1][1])
+
+    @unittest.skipUnless(hasattr(log.linecache, 'lazycache'),
+                         'needs linecache.lazycache')
+    def test_format_stacktrace_zipimport(self):
+        tmpdir = tempfile.mkdtemp()
+        archive = os.path.join(tmpdir, 'zipped.zip')
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('zipped_mod.py',
+                        'import glog, sys\n'
+                        'def stack():\n'
+                        '    return glog._extract_stack(sys._getframe())\n')
+        sys.path.insert(0, archive)
+        try:
+            import zipped_mod
+            lines = log.format_stacktrace(zipped_mod.stack())
+        finally:
+            sys.path.remove(archive)
+            sys.modules.pop('zipped_mod', None)
+            shutil.rmtree(tmpdir)
+        self.assertTrue(lines[-1].endswith(
+            '\treturn glog._extract_stack(sys._getframe())'))
+
     def test_check_not_none(self):
         log.check_notnone('not none')
         self.assertRaises(log.FailedCheckException, log.check_notnone, None)